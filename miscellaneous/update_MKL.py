@@ -4,12 +4,27 @@ import os
 import re
 import sys
 
-from bs4 import BeautifulSoup as bs
 import requests
 
 __target__  = "linux"
 __install__ = "offline"
 
+__URL_RE__ = re.compile(rb"https://[^'\"<>\s]+?_" + __install__.encode() + rb"\.sh")
+
+
+def find_installer_url(page: str) -> str:
+    # stream the page and stop at the first installer link, no DOM needed
+    buf = b""
+    with requests.get(page, stream=True, timeout=10) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=64*1024):
+            # keep only a short tail so a link split across chunks is still found
+            buf = buf[-512:] + chunk
+            m = __URL_RE__.search(buf)
+            if m:
+                return m.group(0).decode()
+    raise ValueError(f"no {__install__} installer link found in {page}")
+
 if __name__ == "__main__":
 
     argv = sys.argv
@@ -23,10 +38,7 @@ if __name__ == "__main__":
     try:
         old_url = re.search(r"https.*?sh", script).group(0)
 
-        soup = bs(requests.get(f"https://www.intel.com/content/www/us/en/developer/tools/oneapi/onemkl-download.html?operatingsystem={__target__}&{__target__}-install={__install__}").content, "html5lib")
-
-        code = soup.find("code", attrs={"class": "language-bash"}).text
-        url  = re.search(r"https.*?sh", code).group(0)
+        url = find_installer_url(f"https://www.intel.com/content/www/us/en/developer/tools/oneapi/onemkl-download.html?operatingsystem={__target__}&{__target__}-install={__install__}")
     except Exception as e:
         print(e)
     else:
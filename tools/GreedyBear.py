@@ -1,25 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
-import copy
+import bisect
 import getpass
 import logging
-import json
 import re
 import shutil
 import subprocess
 import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-@dataclass
+
+@dataclass(slots=True)
 class Queue:
     name: str
     pcpus: int
     avail_ncpus: int
 
-@dataclass
+@dataclass(slots=True)
 class Job:
     id: str
     name: str
@@ -28,7 +34,7 @@ class Job:
     state: str
     ncpus: int
 
-@dataclass
+@dataclass(slots=True)
 class QueueRecord:
     njobq: int # number of jobs in Q state
     pcpus: int # total cpu count?
@@ -40,10 +46,15 @@ class QueueRecord:
 __QSTAT__ = shutil.which("qstat")
 __QMOVE__ = shutil.which("qmove")
 __PBSND__ = shutil.which("pbsnodes")
+__QSLCT__ = shutil.which("qselect")
+
+
+# PBS prints floats such as ".5", which json rejects
+__DOT_FIX__ = re.compile(rb"([\[:,])(\s*)(-?)(\.\d+)")
 
 
-def safe_json_str(content: str) -> str:
-    return re.sub(r"([\[:,])(\s*)(-?)(\.\d+)", r"\g<1>\g<2>\g<3>0\g<4>", content)
+def safe_json_str(content: bytes) -> bytes:
+    return __DOT_FIX__.sub(rb"\g<1>\g<2>\g<3>0\g<4>", content)
 
 
 def get_queue_info(queues: list[str], dry_run: bool=False) -> dict[str, Queue]:
@@ -56,10 +67,12 @@ def get_queue_info(queues: list[str], dry_run: bool=False) -> dict[str, Queue]:
     if dry_run:
         logging.info("dry run: " + " ".join(cmdl))
     else:
-        sp = subprocess.run(cmdl, capture_output=True, check=True, text=True)
-        pbs_info = json.loads(safe_json_str(sp.stdout))
+        sp = subprocess.run(cmdl, capture_output=True, check=True)
+        content = safe_json_str(sp.stdout)
+        pbs_info = json_loads(content)
 
-        logging.debug(safe_json_str(sp.stdout))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(content.decode(errors="replace"))
 
         for _, info in (pbs_info["nodes"]).items():
             if info["queue"] in queues and "pcpus" in info:
@@ -102,7 +115,7 @@ def parse_arguments() -> argparse.Namespace:
         "-t", "--interval",
         type=int,
         default=60,
-        help="Interval in seconds to check job status (default: 60).",
+        help="Interval in seconds to check job status (default: 60). Backs off up to 8x while the job set is unchanged.",
     )
     parser.add_argument(
         "-s", "--scheduler",
@@ -133,24 +146,46 @@ def parse_arguments() -> argparse.Namespace:
         level=getattr(logging, args.log.upper(), logging.DEBUG),
     )
 
-    global __QSTAT__
-    global __QMOVE__
-
     if not __QSTAT__:
         logging.warning("qstat not found")
     if not __QMOVE__:
         logging.warning("qmove not found")
     if not __PBSND__:
         logging.error("pbsnodes not found")
+    if not __QSLCT__:
+        logging.warning("qselect not found, jobs of all users will be queried")
     if args.dry_run:
         logging.info("dry run mode")
 
-    args.queue_info = get_queue_info(args.queue, args.dry_run or not __PBSND__)
+    # whether pbsnodes/qmove are only printed rather than run
+    args.pbsnd_dry_run = args.dry_run or not __PBSND__
+    args.qmove_dry_run = args.dry_run or not __QMOVE__
+
+    args.queue_info = get_queue_info(args.queue, args.pbsnd_dry_run)
+    args.queue_info_ts = time.monotonic()
 
     return args
 
 
-def get_user_jobs(args: argparse.Namespace) -> list[Job]:
+def get_user_job_ids(user: str) -> list[str] | None:
+    # None means "unknown", the caller then falls back to querying all jobs
+    if not __QSLCT__:
+        return None
+
+    sp = subprocess.run(
+        [__QSLCT__, "-u", user],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if sp.returncode:
+        logging.warning(f"qselect failed: {sp.stderr}")
+        return None
+
+    return sp.stdout.split()
+
+
+def get_user_jobs(args: argparse.Namespace, batch: int=100) -> list[Job]:
 
     jobs = []
     cmdl = [__QSTAT__ if __QSTAT__ else "qstat", "-f", "-F", "json"]
@@ -158,58 +193,85 @@ def get_user_jobs(args: argparse.Namespace) -> list[Job]:
     if not __QSTAT__:
         logging.info(f"qstat not found: {' '.join(cmdl)}")
     else:
-        sp = subprocess.run(
-            cmdl,
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        if sp.returncode:
-            logging.warning(sp.stderr)
+        # `qstat -f` has no user filter, narrow it down to the user's job ids,
+        # chunked like qmove to stay clear of argv limits
+        job_ids = get_user_job_ids(args.user)
+        if job_ids is None:
+            cmdls = [cmdl]
         else:
-            try:
-                resp = json.loads(safe_json_str(sp.stdout))
-            except Exception as e:
-                resp = {}
-                logging.error(f"failed to parse json: {e}")
-
-            jd = resp.get("Jobs", {})
-            for k, v in jd.items():
-                if v.get("Job_Owner", "").startswith(args.user):
-                    jobs.append(Job(
-                        id=k,
-                        name=v.get("Job_Name", "unknown"),
-                        owner=v.get("Job_Owner", "unknown"),
-                        queue=v.get("queue", None),
-                        state=v.get("job_state", "?"),
-                        ncpus=(v.get("Resource_List", {})).get("ncpus", 1),
-                    ))
-
-    return jobs
+            cmdls = [cmdl + job_ids[i:i+batch] for i in range(0, len(job_ids), batch)]
 
-
-def move_jobs_to_queue(jobs: list[Job], dest: str, dry_run: bool=False) -> None:
-    for job in jobs:
-        cmdl = [__QMOVE__ if __QMOVE__ else "qmove", dest, job.id]
-        if dry_run:
-            logging.info(f"dry run: {' '.join(cmdl)}")
-        else:
+        jd = {}
+        for c in cmdls:
             sp = subprocess.run(
-                cmdl,
+                c,
                 capture_output=True,
-                text=True,
-                check=False,
+                check=False
             )
             if sp.returncode:
-                logging.error(f"failed to move job: {sp.stdout}\n{sp.stderr}")
+                # jobs finished since qselect make qstat fail, the rest is still reported
+                logging.warning(sp.stderr.decode(errors="replace"))
+            if sp.stdout:
+                try:
+                    jd.update(json_loads(safe_json_str(sp.stdout)).get("Jobs", {}))
+                except Exception as e:
+                    logging.error(f"failed to parse json: {e}")
+
+        for k, v in jd.items():
+            if v.get("Job_Owner", "").startswith(args.user):
+                jobs.append(Job(
+                    id=k,
+                    name=v.get("Job_Name", "unknown"),
+                    owner=v.get("Job_Owner", "unknown"),
+                    queue=v.get("queue", None),
+                    state=v.get("job_state", "?"),
+                    ncpus=(v.get("Resource_List", {})).get("ncpus", 1),
+                ))
 
+    return jobs
 
-def scheduler_balance(jobs: list[Job], args: argparse.Namespace) -> None:
 
-    args.queue_info = get_queue_info(args.queue, args.dry_run or not __PBSND__)
+def move_jobs_to_queue(moves: dict[str, list[Job]], dry_run: bool=False, batch: int=100, workers: int=8) -> None:
+    # qmove accepts several job ids per call, chunked to stay clear of argv limits
+    cmdls = [
+        [__QMOVE__ if __QMOVE__ else "qmove", dest] + [job.id for job in jobs[i:i+batch]]
+        for dest, jobs in moves.items()
+        for i in range(0, len(jobs), batch)
+    ]
+
+    if dry_run:
+        for cmdl in cmdls:
+            logging.info(f"dry run: {' '.join(cmdl)}")
+        return
+
+    # the calls are independent and mostly wait on the PBS server
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(cmdls)))) as executor:
+        results = list(executor.map(
+            lambda cmdl: subprocess.run(cmdl, capture_output=True, text=True, check=False),
+            cmdls,
+        ))
+
+    failed = [sp for sp in results if sp.returncode]
+    if failed:
+        logging.error(f"failed to move job(s) in {len(failed)}/{len(cmdls)} qmove call(s):\n" + "\n".join(
+            f"{' '.join(sp.args)}: {sp.stdout}{sp.stderr}" for sp in failed
+        ))
+
+
+def scheduler_balance(jobs: list[Job], args: argparse.Namespace) -> None:
 
     jobs = [job for job in jobs if job.queue in args.queue]
 
+    # nothing can be moved: skip pbsnodes and the balancing passes
+    if len(args.queue) <= 1 or not any(job.state=="Q" for job in jobs):
+        logging.info("no need for moving")
+        return
+
+    # node resources change slowly, reuse the last pbsnodes result for a while
+    if time.monotonic() - args.queue_info_ts > max(args.interval*5, 300):
+        args.queue_info = get_queue_info(args.queue, args.pbsnd_dry_run)
+        args.queue_info_ts = time.monotonic()
+
     records: dict[str, QueueRecord] = {}
     for queue in args.queue:
         records[queue] = QueueRecord(
@@ -228,37 +290,56 @@ def scheduler_balance(jobs: list[Job], args: argparse.Namespace) -> None:
     waiting_jobs = [job for job in jobs if job.state=="Q" and job.queue in args.queue and args.user in job.owner]
     waiting_jobs.sort(key=lambda x: x.ncpus)
 
+    ncpus = [job.ncpus for job in waiting_jobs]
     for qn, _ in records.items():
-        for i in range(len(waiting_jobs)-1, -1, -1):
-            if waiting_jobs[i].ncpus<=records[qn].ncpus:
-                job = waiting_jobs.pop(i)
-                records[qn].ncpus -= job.ncpus
-                records[qn].recv_jobs.append(job)
+        # jump straight to the largest job that still fits, instead of scanning;
+        # only indices below the last pick are searched, so nothing is popped
+        taken = set()
+        i = bisect.bisect_right(ncpus, records[qn].ncpus)
+        while i:
+            i -= 1
+            taken.add(i)
+            records[qn].ncpus -= ncpus[i]
+            records[qn].recv_jobs.append(waiting_jobs[i])
+            i = bisect.bisect_right(ncpus, records[qn].ncpus, hi=i)
+
+        if taken:
+            waiting_jobs = [job for k, job in enumerate(waiting_jobs) if k not in taken]
+            ncpus = [job.ncpus for job in waiting_jobs]
 
     for job in waiting_jobs:
         records[job.queue].njobq += 1
         records[job.queue].waiting_jobs.append(job)
 
 
-    donor = []
     n_target = len(waiting_jobs) // len(args.queue)
 
     for queue in args.queue: logging.info(f"found {records[queue].njobq} jobs waiting in queue: \"{queue}\"")
     logging.debug(f"total {len(waiting_jobs)} waiting jobs, expected at least {n_target} for each queue")
 
 
+    # single pass: surplus jobs are handed out to under-full queues in queue order,
+    # under-full queues seen before enough surplus wait in `pending`
+    donor: deque[Job] = deque()
+    pending: deque[str] = deque()
+    need: dict[str, int] = {}
     for k, v in records.items():
         if v.njobq > n_target + 1:
             d_jobs = v.waiting_jobs[(n_target-v.njobq):]
-            donor += d_jobs
+            donor.extend(d_jobs)
             logging.debug(f"{k} queue gives away {len(d_jobs)} jobs")
+        elif v.njobq < n_target:
+            need[k] = n_target - v.njobq
+            pending.append(k)
 
-    for k, v in records.items():
-        if v.njobq < n_target:
-            diff = min(n_target-v.njobq, len(donor))
-            records[k].recv_jobs += donor[:diff]
-            donor = donor[diff:]
-            logging.debug(f"{k} queue takes {diff} jobs from donor list")
+        while pending and donor:
+            records[pending[0]].recv_jobs.append(donor.popleft())
+            need[pending[0]] -= 1
+            if not need[pending[0]]:
+                pending.popleft()
+
+    for k, n in need.items():
+        logging.debug(f"{k} queue takes {n_target-records[k].njobq-n} jobs from donor list")
 
     if donor:
         pos = 0
@@ -269,32 +350,22 @@ def scheduler_balance(jobs: list[Job], args: argparse.Namespace) -> None:
             pos = (pos+1) % len(args.queue)
 
 
-    mvdflag = False
+    moves: dict[str, list[Job]] = {}
     for qname, v in records.items():
         mjobs = v.recv_jobs
         mjobs = [job for job in mjobs if job.queue!=qname]
         if mjobs:
             logging.info(f"moving {len(mjobs)} jobs to queue \"{qname}\"...")
-            mvdflag = True
-            move_jobs_to_queue(
-                jobs=mjobs,
-                dest=qname,
-                dry_run=(args.dry_run or __QMOVE__ is None),
-            )
+            moves[qname] = mjobs
 
-    if not mvdflag:
+    if moves:
+        move_jobs_to_queue(
+            moves=moves,
+            dry_run=args.qmove_dry_run,
+        )
+    else:
         logging.info("no need for moving")
 
-    # for k, v in records.items():
-    #     n_move = len(v.recv_jobs)
-    #     if n_move:
-    #         logging.info(f"moving {n_move} jobs to queue \"{k}\"...")
-    #         move_jobs_to_queue(
-    #             jobs=v.recv_jobs,
-    #             dest=k,
-    #             dry_run=(args.dry_run or __QMOVE__ is None),
-    #         )
-
 
 def main() -> None:
     args = parse_arguments()
@@ -304,9 +375,20 @@ def main() -> None:
         for queue, info in args.queue_info.items():
             logging.info(f"found {info.pcpus} cpu(s) configured in \"{queue}\" queue")
 
+        last_sig = None
+        interval = args.interval
+
         while True:
             jobs = get_user_jobs(args)
 
+            # back off while the jobs in the watched queues stay the same, reset on any change
+            sig = hash(tuple(sorted((job.id, job.state, job.queue) for job in jobs if job.queue in args.queue)))
+            interval = min(interval*2, 8*args.interval) if sig==last_sig else args.interval
+            if last_sig is not None and sig!=last_sig:
+                # jobs started, finished or moved: cached free cpus are stale
+                args.queue_info_ts = float("-inf")
+            last_sig = sig
+
             logging.debug("get jobs:")
             for job in jobs:
                 logging.debug(job)
@@ -318,8 +400,8 @@ def main() -> None:
                     logging.warning(f"\"{args.scheduler}\" not implemented")
                     raise KeyboardInterrupt()
 
-            logging.info(f"sleep {args.interval}s...")
-            time.sleep(args.interval)
+            logging.info(f"sleep {interval}s...")
+            time.sleep(interval)
 
     except KeyboardInterrupt:
         logging.info("GreedyBear interrupted, exiting...")